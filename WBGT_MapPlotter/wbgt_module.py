@@ -3,14 +3,48 @@ import geopandas as gpd
 import folium
 import requests
 import zipfile
+import shutil
 import os
 import pandas as pd
+import numpy as np
 from pathlib import Path
 import time
 import tempfile
 import webbrowser
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import json
+import gzip
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import csv
+import io
+
+# pyogrioが使える場合はシェープファイルの読み込みに使用する
+try:
+    import pyogrio  # noqa: F401
+    SHAPEFILE_ENGINE = 'pyogrio'
+except ImportError:
+    SHAPEFILE_ENGINE = None
+
+# WBGT危険度レベルの境界値と、各区分の色・表示名
+WBGT_BINS = np.array([21, 25, 28, 31, 33, 35])
+WBGT_PALETTE = (
+    ('lightblue', 'ほぼ安全（21℃未満）'),
+    ('deepskyblue', '注意（21-25℃）'),
+    ('gold', '警戒（25-28℃）'),
+    ('orange', '厳重警戒（28-31℃）'),
+    ('red', '危険（31-33℃）'),
+    ('mediumvioletred', '極めて危険（33-35℃）'),
+    ('black', '災害級の危険（35℃以上）'),
+)
+WBGT_NO_DATA = ('gray', 'データなし')
+
+# 予測値の時刻は日本時間
+JST = timezone(timedelta(hours=9))
+
+# 地図HTMLの出力内容を変更したら更新する（作成済み地図の再利用判定に使用）
+MAP_RENDER_VERSION = 2
 
 class KanagawaWBGTMapper:
     
@@ -33,12 +67,20 @@ class KanagawaWBGTMapper:
             self.data_dir.mkdir(exist_ok=True)
         
         # キャッシュファイルパス
-        self.cache_file = self.data_dir / "wbgt_cache.json"
+        self.cache_file = self.data_dir / "wbgt_cache.json.gz"
+        # gzip圧縮前の形式のキャッシュファイル（存在すれば読み込みに使用）
+        self.legacy_cache_file = self.data_dir / "wbgt_cache.json"
         self.cache_duration = 45 * 60
+        # 期限切れ後もこの期間内は古いキャッシュを返し、裏で再取得する
+        self.cache_stale_duration = 3 * 60 * 60
+        self._refresh_lock = threading.Lock()
         
         # 神奈川県地図データURL（国土数値情報（国土交通省））
         self.kanagawa_map_url = "https://nlftp.mlit.go.jp/ksj/gml/data/N03/N03-2023/N03-20230101_14_GML.zip"
         self.kanagawa_map_filename = "N03-20230101_14_GML.zip"
+        # 読み込み済み地図データのキャッシュ（WGS84変換・簡略化済みのGeoParquet）
+        self.kanagawa_cache_file = self.data_dir / f"{Path(self.kanagawa_map_filename).stem}_outline.parquet"
+        self.simplify_tolerance = 0.001
         
         # WBGT予測値データURL（暑さ指数(WBGT)予測値等 電子情報提供サービス（環境省））
         self.wbgt_url = "https://www.wbgt.env.go.jp/prev15WG/dl/yohou_kanagawa.csv"
@@ -52,6 +94,8 @@ class KanagawaWBGTMapper:
             "46211": {"name": "三浦", "location": "三浦市初声町下宮田", "lat": 35.1361, "lon": 139.6122}
         }
         self.output_dir = self._setup_output_directory()
+        # HTTP接続を再利用するためのセッション
+        self.session = requests.Session()
         
     def _setup_output_directory(self):
         possible_dirs = [
@@ -72,30 +116,77 @@ class KanagawaWBGTMapper:
         temp_dir = Path(tempfile.mkdtemp(prefix="wbgt_output_"))
         return temp_dir
     
-    def _load_cache(self):
+    def _read_cache_file(self):
         try:
             if self.cache_file.exists():
-                with open(self.cache_file, 'r', encoding='utf-8') as f:
-                    cache_data = json.load(f)
-                
+                with gzip.open(self.cache_file, 'rt', encoding='utf-8') as f:
+                    return json.load(f)
+            if self.legacy_cache_file.exists():
+                with open(self.legacy_cache_file, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+        except Exception:
+            pass
+        return None
+    
+    def _load_cache(self):
+        try:
+            cache_data = self._read_cache_file()
+            if cache_data:
                 cache_time = datetime.fromisoformat(cache_data.get('timestamp', '1970-01-01'))
-                if (datetime.now() - cache_time).total_seconds() < self.cache_duration:
+                if 'soft_expire' in cache_data:
+                    soft_expire = datetime.fromisoformat(cache_data['soft_expire'])
+                else:
+                    soft_expire = cache_time + timedelta(seconds=self.cache_duration)
+                if 'hard_expire' in cache_data:
+                    hard_expire = datetime.fromisoformat(cache_data['hard_expire'])
+                else:
+                    hard_expire = cache_time + timedelta(seconds=self.cache_stale_duration)
+                now = datetime.now()
+                if now < hard_expire:
+                    if now >= soft_expire:
+                        self._start_background_refresh()
                     return cache_data.get('data')
         except Exception:
             pass
         return None
     
-    def _save_cache(self, data):
+    def _save_cache(self, data, etag=None, last_modified=None):
         try:
+            now = datetime.now()
             cache_data = {
-                'timestamp': datetime.now().isoformat(),
+                'timestamp': now.isoformat(),
+                'soft_expire': (now + timedelta(seconds=self.cache_duration)).isoformat(),
+                'hard_expire': (now + timedelta(seconds=self.cache_stale_duration)).isoformat(),
+                'etag': etag,
+                'last_modified': last_modified,
                 'data': data
             }
-            with open(self.cache_file, 'w', encoding='utf-8') as f:
-                json.dump(cache_data, f, ensure_ascii=False, indent=2)
+            # 書き込み途中で中断しても壊れたキャッシュが残らないよう一時ファイル経由で置き換える
+            tmp_file = self.cache_file.with_name(f"{self.cache_file.name}.{threading.get_ident()}.tmp")
+            try:
+                with gzip.open(tmp_file, 'wt', encoding='utf-8') as f:
+                    json.dump(cache_data, f, ensure_ascii=False)
+                os.replace(tmp_file, self.cache_file)
+            finally:
+                if tmp_file.exists():
+                    tmp_file.unlink()
         except Exception:
             pass
     
+    def _start_background_refresh(self):
+        # 既に更新中であれば新たなスレッドは起動しない
+        if not self._refresh_lock.acquire(blocking=False):
+            return
+        threading.Thread(target=self._refresh_cache, daemon=True).start()
+    
+    def _refresh_cache(self):
+        try:
+            self._fetch_wbgt_data()
+        except Exception as e:
+            print(f"WBGT予測値データ更新エラー: {e}")
+        finally:
+            self._refresh_lock.release()
+    
     def download_kanagawa_map_data(self):
         # 地図データをダウンロード
         zip_path = self.data_dir / self.kanagawa_map_filename
@@ -105,12 +196,11 @@ class KanagawaWBGTMapper:
         print("地図データをダウンロード中...")
         try:
             headers = {'User-Agent': 'WBGT Map Tool/1.0 (Educational Purpose)'}
-            response = requests.get(self.kanagawa_map_url, headers=headers, stream=True, timeout=30)
-            response.raise_for_status()
-            with open(zip_path, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
+            with self.session.get(self.kanagawa_map_url, headers=headers, stream=True, timeout=30) as response:
+                response.raise_for_status()
+                response.raw.decode_content = True
+                with open(zip_path, 'wb') as f:
+                    shutil.copyfileobj(response.raw, f, length=1024 * 1024)
             
             return str(zip_path)
         except Exception as e:
@@ -118,6 +208,11 @@ class KanagawaWBGTMapper:
             return None
     
     def load_kanagawa_map(self, zip_path):
+        if self.kanagawa_cache_file.exists():
+            try:
+                return gpd.read_parquet(self.kanagawa_cache_file)
+            except Exception:
+                pass
         if not zip_path or not os.path.exists(zip_path):
             return None
         extract_dir = self.data_dir / f"extracted_{Path(zip_path).stem}"
@@ -128,22 +223,55 @@ class KanagawaWBGTMapper:
             except Exception as e:
                 print(f"ZIP展開エラー: {e}")
                 return None
-        shapefiles = []
-        for root, dirs, files in os.walk(extract_dir):
-            for file in files:
-                if file.endswith('.shp'):
-                    shapefiles.append(Path(root) / file)
+        shapefiles = list(extract_dir.rglob('*.shp'))
         if not shapefiles:
             return None
         shapefile_path = max(shapefiles, key=lambda p: p.stat().st_size)
+        # pyogrioで読めない場合は既定のエンジンでも試す
+        engine_options = [{'engine': SHAPEFILE_ENGINE}, {}] if SHAPEFILE_ENGINE else [{}]
         for encoding in ['shift_jis', 'utf-8', 'cp932']:
-            try:
-                gdf = gpd.read_file(shapefile_path, encoding=encoding)
-                return gdf
-            except:
+            gdf = None
+            for read_options in engine_options:
+                try:
+                    gdf = gpd.read_file(shapefile_path, encoding=encoding, **read_options)
+                    break
+                except:
+                    continue
+            if gdf is None:
                 continue
+            try:
+                gdf = self._prepare_kanagawa_map(gdf)
+            except Exception as e:
+                print(f"地図データ加工エラー: {e}")
+                return None
+            self._save_map_cache(gdf)
+            return gdf
         return None
     
+    def _prepare_kanagawa_map(self, gdf):
+        # 表示用にWGS84へ変換し、県全体の1ポリゴンにまとめてから境界を簡略化する
+        # （市区町村ごとに簡略化すると隣接境界に隙間や重なりが生じるため）
+        if gdf.crs is None:
+            # .prjが無い場合は国土数値情報の測地系（JGD2011）とみなす
+            gdf = gdf.set_crs('EPSG:6668')
+        gdf = gdf.to_crs('EPSG:4326').dissolve()
+        gdf['geometry'] = gdf.geometry.simplify(self.simplify_tolerance, preserve_topology=True)
+        return gdf
+    
+    def _save_map_cache(self, gdf):
+        try:
+            gdf.to_parquet(self.kanagawa_cache_file)
+        except Exception:
+            pass
+
+    
+    def download_all_data(self, force_update=False):
+        # 地図データとWBGT予測値データは互いに独立しているため並行して取得する
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            map_future = executor.submit(self.download_kanagawa_map_data)
+            wbgt_future = executor.submit(self.download_wbgt_data, force_update)
+            return map_future.result(), wbgt_future.result()
+    
     def download_wbgt_data(self, force_update=False):
         # WBGT予測値データをダウンロード
         if not force_update:
@@ -152,72 +280,74 @@ class KanagawaWBGTMapper:
                 return cached_data
         print("WBGT予測値データをダウンロード中...")
         try:
-            headers = {
-                'User-Agent': 'WBGT Map Tool/1.0 (Educational Purpose; Rate Limited)',
-                'Accept': 'text/csv,text/plain',
-                'Cache-Control': 'no-cache'
-            }
-            response = requests.get(self.wbgt_url, headers=headers, timeout=20)
-            response.raise_for_status()
-            csv_content = response.text
-            self._save_cache(csv_content)
-            return csv_content
+            return self._fetch_wbgt_data()
         except Exception as e:
             print(f"WBGT予測値データダウンロードエラー: {e}")
             return None
     
+    def _fetch_wbgt_data(self):
+        headers = {
+            'User-Agent': 'WBGT Map Tool/1.0 (Educational Purpose; Rate Limited)',
+            'Accept': 'text/csv,text/plain',
+            'Cache-Control': 'no-cache'
+        }
+        # 前回取得時の検証子があれば条件付きリクエストにする
+        cache_data = self._read_cache_file() or {}
+        cached_csv = cache_data.get('data')
+        if cached_csv:
+            if cache_data.get('etag'):
+                headers['If-None-Match'] = cache_data['etag']
+            if cache_data.get('last_modified'):
+                headers['If-Modified-Since'] = cache_data['last_modified']
+        response = self.session.get(self.wbgt_url, headers=headers, timeout=20)
+        if response.status_code == 304 and cached_csv:
+            self._save_cache(cached_csv, cache_data.get('etag'), cache_data.get('last_modified'))
+            return cached_csv
+        response.raise_for_status()
+        csv_content = response.text
+        self._save_cache(csv_content, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+        return csv_content
+    
     def parse_wbgt_data(self, csv_content):
         if not csv_content:
             return None, None
         try:
-            lines = csv_content.strip().split('\n')
-            if len(lines) < 2:
-                return None, None
+            buffer = io.StringIO(csv_content.strip())
             # 1行目：予測日次
-            time_header = lines[0].split(',')
-            time_slots = []
-            for i in range(2, len(time_header)):
-                if time_header[i].strip():
-                    time_str = time_header[i].strip()
-                    if len(time_str) == 10:
-                        year = int(time_str[:4])
-                        month = int(time_str[4:6])
-                        day = int(time_str[6:8])
-                        hour = int(time_str[8:10])
-                        if hour == 24:
-                            dt = datetime(year, month, day) + timedelta(days=1)
-                            hour = 0
-                        else:
-                            dt = datetime(year, month, day, hour)
-                        time_slots.append(dt)
+            time_header = next(csv.reader(buffer), None)
+            if time_header is None:
+                return None, None
+            # YYYYMMDDHH形式（24時は翌日0時）を一括で変換する
+            tokens = [t.strip() for t in time_header[2:] if len(t.strip()) == 10]
+            hours = np.array([int(t[8:10]) for t in tokens], dtype=np.int64)
+            base = pd.to_datetime([t[:8] for t in tokens], format='%Y%m%d')
+            time_slots = (base + pd.to_timedelta(hours, unit='h')).to_pydatetime().tolist()
+            
+            # 2行目以降：各地点の時系列データ（pandasで一括読み込み）
+            # 列名を1行目の列数分与え、列が足りない行は欠損値として扱う
+            value_end = 2 + len(time_slots)
+            df = pd.read_csv(
+                buffer,
+                header=None,
+                names=range(len(time_header)),
+                index_col=False,
+                dtype={0: str, 1: str},
+                na_values=[''],
+                skipinitialspace=True
+            )
+            df[0] = df[0].str.strip()
+            df = df[df[0].isin(list(self.wbgt_stations))]
+            values = df.iloc[:, 2:value_end].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=np.float64) / 10.0
+            values = values.astype(object)
+            values[pd.isna(values)] = None
             
-            # 2行目以降：各地点の時系列データ
             wbgt_data = {}
-            for line in lines[1:]:
-                if not line.strip():
-                    continue
-                elements = line.split(',')
-                if len(elements) < 3:
-                    continue
-                station_id = elements[0].strip()
-                update_time = elements[1].strip()
-                if station_id in self.wbgt_stations:
-                    wbgt_values = []
-                    for i in range(2, min(len(elements), 2 + len(time_slots))):
-                        value_str = elements[i].strip()
-                        if value_str:
-                            try:
-                                wbgt_value = int(value_str) / 10.0
-                                wbgt_values.append(wbgt_value)
-                            except ValueError:
-                                wbgt_values.append(None)
-                        else:
-                            wbgt_values.append(None)
-                    wbgt_data[station_id] = {
-                        'station_info': self.wbgt_stations[station_id],
-                        'update_time': update_time,
-                        'values': wbgt_values
-                    }
+            for row_idx, (station_id, update_time) in enumerate(zip(df[0], df[1].fillna(''))):
+                wbgt_data[station_id] = {
+                    'station_info': self.wbgt_stations[station_id],
+                    'update_time': update_time.strip(),
+                    'values': values[row_idx].tolist()
+                }
             return time_slots, wbgt_data
             
         except Exception as e:
@@ -227,28 +357,36 @@ class KanagawaWBGTMapper:
     def get_wbgt_color(self, wbgt_value):
         # WBGTに応じた色を設定
         if wbgt_value is None:
-            return 'gray', 'データなし'
-        if wbgt_value >= 35:
-            return 'black', '災害級の危険（35℃以上）'
-        elif wbgt_value >= 33:
-            return 'mediumvioletred', '極めて危険（33-35℃）'
-        elif wbgt_value >= 31:
-            return 'red', '危険（31-33℃）'
-        elif wbgt_value >= 28:
-            return 'orange', '厳重警戒（28-31℃）'
-        elif wbgt_value >= 25:
-            return 'gold', '警戒（25-28℃）'
-        elif wbgt_value >= 21:
-            return 'deepskyblue', '注意（21-25℃）'
-        else:
-            return 'lightblue', 'ほぼ安全（21℃未満）'
+            return WBGT_NO_DATA
+        return WBGT_PALETTE[int(np.digitize(wbgt_value, WBGT_BINS))]
     
-    def create_forecast_table(self, station_id, wbgt_data, time_slots):
+    def get_wbgt_colors_batch(self, values):
+        # 予測値の配列に対する色と危険度をまとめて求める
+        values = np.array(values, dtype=np.float64)
+        indices = np.digitize(values, WBGT_BINS)
+        missing = np.isnan(values)
+        colors = []
+        levels = []
+        for idx, is_missing in zip(indices.tolist(), missing.tolist()):
+            color, level = WBGT_NO_DATA if is_missing else WBGT_PALETTE[idx]
+            colors.append(color)
+            levels.append(level)
+        return colors, levels
+    
+    def format_time_slots(self, time_slots):
+        # 予測値一覧表の時刻表示（全地点で共通）
+        return [time_slot.strftime("%m/%d %H時") for time_slot in time_slots]
+    
+    def time_slot_timestamps(self, time_slots):
+        # 過去の時刻の行をブラウザ側で判定するためのUNIX時刻（ミリ秒）
+        return [int(time_slot.replace(tzinfo=JST).timestamp() * 1000) for time_slot in time_slots]
+    
+    def create_forecast_table(self, station_id, wbgt_data, time_slots, formatted_times=None, timestamps=None):
         if station_id not in wbgt_data:
             return "<p>予測データがありません</p>"
         station_data = wbgt_data[station_id]
         values = station_data['values']
-        table_html = '''
+        parts = ['''
         <div style="max-height: 200px; overflow-y: auto; margin-top: 10px; border: 1px solid #ddd;">
             <table style="width: 100%; font-size: 11px; border-collapse: collapse;">
                 <thead style="background-color: #f5f5f5; position: sticky; top: 0;">
@@ -259,29 +397,26 @@ class KanagawaWBGTMapper:
                     </tr>
                 </thead>
                 <tbody>
-        '''
-        
+        ''']
+        colors, levels = self.get_wbgt_colors_batch(values)
+        if formatted_times is None:
+            formatted_times = self.format_time_slots(time_slots)
+        if timestamps is None:
+            timestamps = self.time_slot_timestamps(time_slots)
+        # 過去の時刻の行の網掛けは表示時にブラウザ側で行う（shadePastForecastRows）
         for i, time_slot in enumerate(time_slots):
             if i < len(values):
                 wbgt_value = values[i]
+                color = colors[i]
+                level = levels[i]
                 if wbgt_value is not None:
-                    color, level = self.get_wbgt_color(wbgt_value)
                     wbgt_text = f"{wbgt_value:.0f}℃"
                 else:
-                    color = 'gray'
-                    level = 'データなし'
                     wbgt_text = '-'
-                current_time = datetime.now()
-                if time_slot <= current_time:
-                    row_style = "background-color: #f0f0f0; color: #888;"
-                    time_prefix = ""
-                else:
-                    row_style = ""
-                    time_prefix = ""
-                table_html += f'''
-                    <tr style="{row_style}">
+                parts.append(f'''
+                    <tr class="wbgt-forecast-row" data-time="{timestamps[i]}">
                         <td style="padding: 3px 5px; border: 1px solid #ddd; font-size: 10px;">
-                            {time_prefix}{time_slot.strftime("%m/%d %H時")}
+                            {formatted_times[i]}
                         </td>
                         <td style="padding: 3px 5px; border: 1px solid #ddd; text-align: center; 
                                    color: {color}; font-weight: bold;">
@@ -292,19 +427,17 @@ class KanagawaWBGTMapper:
                             {level.split('（')[0]}
                         </td>
                     </tr>
-                '''
-        table_html += '''
+                ''')
+        parts.append('''
                 </tbody>
             </table>
         </div>
-        '''  
-        return table_html
+        ''')
+        return ''.join(parts)
     
     def create_wbgt_map(self, kanagawa_gdf, time_slots, wbgt_data):
         print("地図を作成中...")
         try:
-            if kanagawa_gdf.crs != 'EPSG:4326':
-                kanagawa_gdf = kanagawa_gdf.to_crs('EPSG:4326')
             bounds = kanagawa_gdf.total_bounds
             center_lon = (bounds[0] + bounds[2]) / 2
             center_lat = (bounds[1] + bounds[3]) / 2 - 0.2
@@ -322,7 +455,7 @@ class KanagawaWBGTMapper:
             '''
             m.get_root().html.add_child(folium.Element(title_html))
             folium.GeoJson(
-                kanagawa_gdf,
+                json.loads(kanagawa_gdf.to_json()),
                 style_function=lambda feature: {
                     'fillColor': 'lightgray',
                     'color': 'darkgray',
@@ -330,103 +463,121 @@ class KanagawaWBGTMapper:
                     'fillOpacity': 0.2,
                 }
             ).add_to(m)
+            # 地図に埋め込む予測データ（1度だけシリアライズする）
+            map_payload = {
+                'wbgtData': {'stations': {}, 'values': {}},
+                'forecastTables': {},
+                'timeSlots': [],
+                'timeLabels': [],
+                'wbgtBins': WBGT_BINS.tolist(),
+                'wbgtPalette': WBGT_PALETTE,
+                'wbgtNoData': WBGT_NO_DATA
+            }
             if wbgt_data and time_slots:
-                time_data = {}
-                for time_idx, time_slot in enumerate(time_slots):
-                    time_key = time_slot.strftime("%Y%m%d%H")
-                    time_data[time_key] = {
-                        'datetime': time_slot.strftime("%m月%d日 %H時"),
-                        'full_datetime': time_slot.strftime("%Y年%m月%d日 %H時"),
-                        'stations': {}
+                # 予測値一覧表は時刻によらないため地点ごとに1度だけ作成する
+                formatted_times = self.format_time_slots(time_slots)
+                timestamps = self.time_slot_timestamps(time_slots)
+                forecast_tables = {
+                    station_id: self.create_forecast_table(station_id, wbgt_data, time_slots, formatted_times, timestamps)
+                    for station_id in wbgt_data
+                }
+                # 地点の固定情報と時系列の予測値を分けて保持する
+                station_static = {}
+                station_values = {}
+                for station_id, data in wbgt_data.items():
+                    station_info = data['station_info']
+                    station_static[station_id] = {
+                        'name': station_info['name'],
+                        'location': station_info['location'],
+                        'lat': station_info['lat'],
+                        'lon': station_info['lon'],
+                        'update_time': data['update_time']
                     }
-                    for station_id, data in wbgt_data.items():
-                        station_info = data['station_info']
-                        values = data['values']
-                        update_time = data['update_time']
-                        current_value = values[time_idx] if time_idx < len(values) else None
-                        color, level = self.get_wbgt_color(current_value)
-                        forecast_table = self.create_forecast_table(station_id, wbgt_data, time_slots)
-                        time_data[time_key]['stations'][station_id] = {
-                            'name': station_info['name'],
-                            'location': station_info['location'],
-                            'lat': station_info['lat'],
-                            'lon': station_info['lon'],
-                            'value': current_value,
-                            'color': color,
-                            'level': level,
-                            'update_time': update_time,
-                            'forecast_table': forecast_table
-                        }
-                js_data = json.dumps(time_data, ensure_ascii=False)
-                first_time_key = list(time_data.keys())[0] if time_data else None
-                if first_time_key:
-                    for station_id, station_data in time_data[first_time_key]['stations'].items():
-                        popup_content = f'''
-                        <div style="font-family: Arial; font-size: 12px; width: 320px;">
-                            <h4 style="margin: 5px 0; color: {station_data['color']};">{station_data['name']} 観測地点</h4>
-                            <p><b>所在地:</b> {station_data['location']}</p>
-                            <p><b>データ更新:</b> {station_data['update_time']}</p>
-                        '''
-                        if station_data['value'] is not None:
-                            popup_content += f'''
-                            <p><b>{time_data[first_time_key]['datetime']}のWBGT値:</b> <span style="color: {station_data['color']}; font-weight: bold; font-size: 14px;">{station_data['value']:.0f}℃</span></p>
-                            <p><b>危険度:</b> <span style="color: {station_data['color']}; font-weight: bold;">{station_data['level']}</span></p>
-                            '''
-                        else:
-                            popup_content += f'<p><b>{time_data[first_time_key]["datetime"]}のWBGT値:</b> データなし</p>'
+                    station_values[station_id] = data['values']
+                map_payload['wbgtData'] = {'stations': station_static, 'values': station_values}
+                map_payload['forecastTables'] = forecast_tables
+                map_payload['timeSlots'] = [t.strftime("%Y%m%d%H") for t in time_slots]
+                map_payload['timeLabels'] = [t.strftime("%Y年%m月%d日 %H時") for t in time_slots]
+                first_datetime = time_slots[0].strftime("%m月%d日 %H時")
+                for station_id, station_data in station_static.items():
+                    values = station_values[station_id]
+                    first_value = values[0] if values else None
+                    color, level = self.get_wbgt_color(first_value)
+                    popup_content = f'''
+                    <div style="font-family: Arial; font-size: 12px; width: 320px;">
+                        <h4 style="margin: 5px 0; color: {color};">{station_data['name']} 観測地点</h4>
+                        <p><b>所在地:</b> {station_data['location']}</p>
+                        <p><b>データ更新:</b> {station_data['update_time']}</p>
+                    '''
+                    if first_value is not None:
                         popup_content += f'''
-                        <h5 style="margin: 10px 0 5px 0; color: #333;">今後の予測値一覧</h5>
-                        {station_data['forecast_table']}
-                        </div>
+                        <p><b>{first_datetime}のWBGT値:</b> <span style="color: {color}; font-weight: bold; font-size: 14px;">{first_value:.0f}℃</span></p>
+                        <p><b>危険度:</b> <span style="color: {color}; font-weight: bold;">{level}</span></p>
                         '''
-                        tooltip_text = f"{station_data['name']}: {time_data[first_time_key]['datetime']}"
-                        if station_data['value'] is not None:
-                            tooltip_text += f" | {station_data['value']:.0f}℃"
-                        else:
-                            tooltip_text += " | データなし"
-                        folium.CircleMarker(
-                            location=[station_data['lat'], station_data['lon']],
-                            radius=12,
-                            popup=folium.Popup(popup_content, max_width=350),
-                            tooltip=tooltip_text,
-                            color='black',
-                            weight=1,
-                            fillColor=station_data['color'],
-                            fillOpacity=0.8
-                        ).add_to(m)
-                        folium.Marker(
-                            location=[station_data['lat'], station_data['lon']],
-                            icon=folium.DivIcon(
-                                html=f'''<div style="
-                                    font-size: 9px; 
-                                    color: black; 
-                                    font-weight: bold; 
-                                    background-color: rgba(255,255,255,0.9); 
-                                    border: 1px solid black; 
-                                    padding: 1px 3px; 
-                                    border-radius: 3px; 
-                                    text-align: center;
-                                    margin-top: 15px;
-                                ">{station_data["name"]}</div>''',
-                                icon_size=(None, None),
-                                icon_anchor=(0, 0)
-                            )
-                        ).add_to(m)
+                    else:
+                        popup_content += f'<p><b>{first_datetime}のWBGT値:</b> データなし</p>'
+                    popup_content += f'''
+                    <h5 style="margin: 10px 0 5px 0; color: #333;">今後の予測値一覧</h5>
+                    {forecast_tables[station_id]}
+                    </div>
+                    '''
+                    tooltip_text = f"{station_data['name']}: {first_datetime}"
+                    if first_value is not None:
+                        tooltip_text += f" | {first_value:.0f}℃"
+                    else:
+                        tooltip_text += " | データなし"
+                    folium.CircleMarker(
+                        location=[station_data['lat'], station_data['lon']],
+                        radius=12,
+                        popup=folium.Popup(popup_content, max_width=350),
+                        tooltip=tooltip_text,
+                        color='black',
+                        weight=1,
+                        fillColor=color,
+                        fillOpacity=0.8
+                    ).add_to(m)
+                    folium.Marker(
+                        location=[station_data['lat'], station_data['lon']],
+                        icon=folium.DivIcon(
+                            html=f'''<div style="
+                                font-size: 9px; 
+                                color: black; 
+                                font-weight: bold; 
+                                background-color: rgba(255,255,255,0.9); 
+                                border: 1px solid black; 
+                                padding: 1px 3px; 
+                                border-radius: 3px; 
+                                text-align: center;
+                                margin-top: 15px;
+                            ">{station_data["name"]}</div>''',
+                            icon_size=(None, None),
+                            icon_anchor=(0, 0)
+                        )
+                    ).add_to(m)
             
-            # 凡例
-            legend_html = '''
+            # 凡例（危険度の高い順に、WBGT_BINSとWBGT_PALETTEから作成）
+            bins = WBGT_BINS.tolist()
+            legend_rows = []
+            for idx in reversed(range(len(WBGT_PALETTE))):
+                color, level = WBGT_PALETTE[idx]
+                if idx == 0:
+                    range_text = f"{bins[0]}℃未満"
+                elif idx == len(bins):
+                    range_text = f"{bins[-1]}℃以上"
+                else:
+                    range_text = f"{bins[idx - 1]}-{bins[idx]}℃"
+                legend_rows.append(
+                    f'<p style="margin: 2px 0;"><span style="color: {color}; font-size: 16px;">●</span> '
+                    f'{level.split("（")[0]} ({range_text})</p>'
+                )
+            legend_rows_html = ''.join(legend_rows)
+            legend_html = f'''
             <div style="position: fixed; 
                         bottom: 130px; left: 20px; width: 200x; height: 220px; 
                         background-color: white; border:2px solid grey; z-index:9999; 
                         font-size:12px; padding: 10px; border-radius: 5px; box-shadow: 2px 2px 5px rgba(0,0,0,0.3);">
             <p style="margin: 0 0 8px 0;"><b>WBGT危険度レベル</b></p>
-            <p style="margin: 2px 0;"><span style="color: black; font-size: 16px;">●</span> 災害級の危険 (35℃以上)</p>
-            <p style="margin: 2px 0;"><span style="color: mediumvioletred; font-size: 16px;">●</span> 極めて危険 (33-35℃)</p>
-            <p style="margin: 2px 0;"><span style="color: red; font-size: 16px;">●</span> 危険 (31-33℃)</p>
-            <p style="margin: 2px 0;"><span style="color: orange; font-size: 16px;">●</span> 厳重警戒 (28-31℃)</p>
-            <p style="margin: 2px 0;"><span style="color: gold; font-size: 16px;">●</span> 警戒 (25-28℃)</p>
-            <p style="margin: 2px 0;"><span style="color: deepskyblue; font-size: 16px;">●</span> 注意 (21-25℃)</p>
-            <p style="margin: 2px 0;"><span style="color: lightblue; font-size: 16px;">●</span> ほぼ安全 (21℃未満)</p>
+            {legend_rows_html}
             </div>
             '''
             m.get_root().html.add_child(folium.Element(legend_html))
@@ -474,6 +625,7 @@ class KanagawaWBGTMapper:
             '''
             m.get_root().html.add_child(folium.Element(slider_html))
             
+            js_payload = json.dumps(map_payload, ensure_ascii=False, separators=(',', ':'))
             js_code = f'''
             <style>
             .custom-div-icon {{
@@ -486,9 +638,14 @@ class KanagawaWBGTMapper:
             }}
             </style>
             <script>
-            var wbgtData = {js_data};
-            var timeSlots = {json.dumps([t.strftime("%Y%m%d%H") for t in time_slots])};
-            var timeLabels = {json.dumps([t.strftime("%Y年%m月%d日 %H時") for t in time_slots])};
+            var wbgtPayload = {js_payload};
+            var wbgtData = wbgtPayload.wbgtData;
+            var forecastTables = wbgtPayload.forecastTables;
+            var timeSlots = wbgtPayload.timeSlots;
+            var timeLabels = wbgtPayload.timeLabels;
+            var wbgtBins = wbgtPayload.wbgtBins;
+            var wbgtPalette = wbgtPayload.wbgtPalette;
+            var wbgtNoData = wbgtPayload.wbgtNoData;
             var currentTimeIndex = 0;
             var markers = [];
             var map = null;
@@ -507,14 +664,10 @@ class KanagawaWBGTMapper:
             }}
             
             function getWBGTColor(value) {{
-                if (value === null || value === undefined) return ['gray', 'データなし'];
-                if (value >= 35) return ['black', '災害級の危険（35℃以上）'];
-                if (value >= 33) return ['mediumvioletred', '極めて危険（33-35℃）'];
-                if (value >= 31) return ['red', '危険（31-33℃）'];
-                if (value >= 28) return ['orange', '厳重警戒（28-31℃）'];
-                if (value >= 25) return ['gold', '警戒（25-28℃）'];
-                if (value >= 21) return ['deepskyblue', '注意（21-25℃）'];
-                return ['lightblue', 'ほぼ安全（21℃未満）'];
+                if (value === null || value === undefined) return wbgtNoData;
+                var index = 0;
+                while (index < wbgtBins.length && value >= wbgtBins[index]) index++;
+                return wbgtPalette[index];
             }}
             
             function clearAllMarkers() {{
@@ -548,23 +701,26 @@ class KanagawaWBGTMapper:
                 if (!mapObj) {{
                     return;
                 }}
-                var timeKey = timeSlots[timeIndex];
-                var timeData = wbgtData[timeKey];
-                Object.keys(timeData.stations).forEach(function(stationId) {{
-                    var station = timeData.stations[stationId];
+                Object.keys(wbgtData.stations).forEach(function(stationId) {{
+                    var station = wbgtData.stations[stationId];
+                    var value = wbgtData.values[stationId][timeIndex];
+                    if (value === undefined) value = null;
+                    var wbgtColor = getWBGTColor(value);
+                    var color = wbgtColor[0];
+                    var level = wbgtColor[1];
                     var circleMarker = L.circleMarker(
                         [station.lat, station.lon],
                         {{
                             radius: 12,
                             color: 'black',
                             weight: 1,
-                            fillColor: station.color,
+                            fillColor: color,
                             fillOpacity: 0.8
                         }}
                     );
                     var tooltipText = station.name + ': ' + timeLabels[timeIndex];
-                    if (station.value !== null) {{
-                        tooltipText += ' | ' + station.value.toFixed(0) + '℃';
+                    if (value !== null) {{
+                        tooltipText += ' | ' + value.toFixed(0) + '℃';
                     }} else {{
                         tooltipText += ' | データなし';
                     }}
@@ -573,14 +729,14 @@ class KanagawaWBGTMapper:
                     popupContent += '<h4 style="margin: 5px 0;">' + station.name + '</h4>';
                     popupContent += '<p><b>所在地:</b> ' + station.location + '</p>';
                     popupContent += '<p><b>データ更新:</b> ' + station.update_time + '</p>';
-                    if (station.value !== null) {{
-                        popupContent += '<p><b>' + timeLabels[timeIndex] + 'のWBGT値:</b> <span style="color: ' + station.color + '; font-weight: bold; font-size: 14px;">' + station.value.toFixed(0) + '℃</span></p>';
-                        popupContent += '<p><b>危険度:</b> <span style="color: ' + station.color + '; font-weight: bold;">' + station.level + '</span></p>';
+                    if (value !== null) {{
+                        popupContent += '<p><b>' + timeLabels[timeIndex] + 'のWBGT値:</b> <span style="color: ' + color + '; font-weight: bold; font-size: 14px;">' + value.toFixed(0) + '℃</span></p>';
+                        popupContent += '<p><b>危険度:</b> <span style="color: ' + color + '; font-weight: bold;">' + level + '</span></p>';
                     }} else {{
                         popupContent += '<p><b>' + timeLabels[timeIndex] + 'のWBGT値:</b> データなし</p>';
                     }}
                     popupContent += '<h5 style="margin: 10px 0 5px 0; color: #333;">今後の予測値一覧</h5>';
-                    popupContent += station.forecast_table;
+                    popupContent += forecastTables[stationId];
                     popupContent += '</div>';
                     circleMarker.bindPopup(popupContent, {{maxWidth: 350}});
                     var labelMarker = L.marker(
@@ -622,9 +778,23 @@ class KanagawaWBGTMapper:
                 }}, 300);
             }}
             
+            function shadePastForecastRows(container) {{
+                if (!container) return;
+                var now = Date.now();
+                var rows = container.querySelectorAll('.wbgt-forecast-row');
+                Array.prototype.forEach.call(rows, function(row) {{
+                    var isPast = parseInt(row.getAttribute('data-time'), 10) <= now;
+                    row.style.backgroundColor = isPast ? '#f0f0f0' : '';
+                    row.style.color = isPast ? '#888' : '';
+                }});
+            }}
+            
             function initializeMap() {{
                 var mapObj = getMapObject();
                 if (mapObj) {{
+                    mapObj.on('popupopen', function(e) {{
+                        shadePastForecastRows(e.popup.getElement());
+                    }});
                     clearAllMarkers();
                     createMarkersForTime(0);
                 }} else {{
@@ -648,10 +818,48 @@ class KanagawaWBGTMapper:
             print(f"地図作成エラー: {e}")
             return None
     
-    def save_and_open_map(self, map_obj, filename="kanagawa_wbgt_map.html"):
+    def _content_hash(self, csv_content):
+        # 予測値データに加えて地図HTMLの出力形式のバージョンも含める
+        hasher = hashlib.blake2b(f"{MAP_RENDER_VERSION}\n".encode('utf-8'))
+        hasher.update(csv_content.encode('utf-8'))
+        return hasher.hexdigest()
+    
+    def get_rendered_map(self, csv_content, filename="kanagawa_wbgt_map.html"):
+        # 同じ予測値データから作成済みの地図があればそのパスを返す
+        if not csv_content:
+            return None
+        output_path = self.output_dir / filename
+        hash_file = self._render_hash_file(output_path)
+        try:
+            if output_path.exists() and hash_file.exists():
+                if hash_file.read_text(encoding='utf-8').strip() == self._content_hash(csv_content):
+                    return output_path
+        except OSError:
+            pass
+        return None
+    
+    def _render_hash_file(self, output_path):
+        # 地図HTMLごとに、作成元の予測値データのハッシュを隣に保存する
+        return Path(output_path).with_suffix('.hash')
+    
+    def save_map(self, map_obj, output_path, csv_content=None):
+        # 保存前に古いハッシュを消し、作成元が分かる場合のみ書き直す
+        hash_file = self._render_hash_file(output_path)
+        try:
+            hash_file.unlink(missing_ok=True)
+        except OSError:
+            pass
+        map_obj.save(str(output_path))
+        if csv_content:
+            try:
+                hash_file.write_text(self._content_hash(csv_content), encoding='utf-8')
+            except OSError:
+                pass
+    
+    def save_and_open_map(self, map_obj, filename="kanagawa_wbgt_map.html", csv_content=None):
         try:
             output_path = self.output_dir / filename
-            map_obj.save(str(output_path))
+            self.save_map(map_obj, output_path, csv_content)
             webbrowser.open(f"file://{output_path.resolve()}")
             return str(output_path)
         except Exception as e: